@@ -1,5 +1,7 @@
 import streamlit as st
 import pandas as pd
+import numpy as np
+from scipy.sparse import csr_matrix, diags
 import gspread
 from google.oauth2.service_account import Credentials
 from google.auth.transport.requests import Request
@@ -9,17 +11,18 @@ import urllib.parse
 from datetime import datetime
 from deep_translator import GoogleTranslator
 import json
+import os
+import io
+from PIL import Image
 import re
 import threading
-import wikipedia
+import queue
+from collections import deque, Counter
+from concurrent.futures import ThreadPoolExecutor
 
 # --- KONFIGURATION ---
 st.set_page_config(page_title="Meine Leseliste", page_icon="📚", layout="wide")
 
-# --- SPRACHE EINSTELLEN ---
-try: wikipedia.set_lang("de")
-except: pass
-
 # --- STATE INIT ---
 NAV_OPTIONS = ["✍️ Neu", "🔍 Sammlung", "🔮 Merkliste", "👥 Statistik"]
 if "active_tab" not in st.session_state: st.session_state.active_tab = NAV_OPTIONS[1]
@@ -155,72 +158,392 @@ def get_placeholder_from_drive(creds):
         return None
     except Exception as e: return None
 
+# --- SHARED CACHE ---
+# Einmal pro Prozess im Speicher und zusätzlich auf Platte, damit ein Neustart nicht neu lädt
+CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".cache")
+PLACEHOLDER_TTL = 7 * 86400
+PLACEHOLDER_RETRY = 300  # nach fehlgeschlagenem Drive-Abruf
+PLACEHOLDER_WIDTH = 160  # 2x der 80px-Kachel
+MODELS_TTL = 6 * 3600
+MODELS_RETRY = 60
+DEFAULT_MODEL = "gemma-3-27b-it"
+
+@st.cache_resource
+def get_shared_cache():
+    return {"lock": threading.Lock(), "placeholder": None, "models": None, "models_attempt": 0, "refreshing": False}
+
+SHARED_CACHE = get_shared_cache()
+
+def read_disk_cache(name, ttl):
+    path = os.path.join(CACHE_DIR, name)
+    try:
+        mtime = os.path.getmtime(path)
+        if time.time() - mtime > ttl: return None, 0
+        with open(path, "rb") as f: return f.read(), mtime
+    except OSError: return None, 0
+
+def write_disk_cache(name, data):
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        tmp = os.path.join(CACHE_DIR, f".{name}.tmp")
+        with open(tmp, "wb") as f: f.write(data)
+        os.replace(tmp, os.path.join(CACHE_DIR, name))
+    except OSError: pass
+
+def downscale_image(data, width=PLACEHOLDER_WIDTH):
+    try:
+        img = Image.open(io.BytesIO(data))
+        if img.width > width: img = img.resize((width, max(1, round(img.height * width / img.width))), Image.LANCZOS)
+        out = io.BytesIO()
+        img.save(out, format="PNG", optimize=True)
+        return out.getvalue()
+    except Exception: return data
+
+def get_placeholder(creds, refresh=False):
+    with SHARED_CACHE["lock"]: entry = SHARED_CACHE["placeholder"]
+    if not refresh and entry:
+        ttl = PLACEHOLDER_TTL if entry[1] else PLACEHOLDER_RETRY
+        if time.time() - entry[0] < ttl: return entry[1]
+    # Platte und Drive ohne Lock abfragen, damit andere Sessions und der Modell-Refresh nicht warten
+    data, mtime = (None, 0) if refresh else read_disk_cache("placeholder.png", PLACEHOLDER_TTL)
+    if not data:
+        raw = get_placeholder_from_drive(creds)
+        data, mtime = (downscale_image(raw) if raw else None), time.time()
+        if data: write_disk_cache("placeholder.png", data)
+    with SHARED_CACHE["lock"]:
+        # Einen vorhandenen Platzhalter nicht durch einen Fehlschlag ersetzen
+        current = SHARED_CACHE["placeholder"]
+        if data or not (current and current[1]): SHARED_CACHE["placeholder"] = (mtime, data)
+        else: data = current[1]
+    return data
+
+# --- SHEETS QUOTA ---
+# Google erlaubt ca. 60 Lese- und 60 Schreib-Requests pro Minute und Nutzer; etwas Reserve lassen
+SHEETS_READS_PER_MIN = 55
+SHEETS_WRITES_PER_MIN = 55
+FLUSH_DELAY = 1.0
+FLUSH_RETRY_MAX = 60
+FLUSH_MAX_ATTEMPTS = 5
+
+@st.cache_resource
+def get_quota_state():
+    return {"read": deque(), "write": deque(), "lock": threading.Lock(), "throttled": 0, "last_event": None}
+
+QUOTA = get_quota_state()
+
+def report_throttle(message):
+    ts = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    QUOTA["throttled"] += 1
+    QUOTA["last_event"] = (time.time(), message)
+    # Nur in den Speicher-Log: ein Sheets-Log würde selbst wieder Quota kosten
+    LOG_BUFFER.appendleft([ts, "QUOTA", message])
+
+def report_write_error(message):
+    ts = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    QUOTA["last_event"] = (time.time(), message)
+    LOG_BUFFER.appendleft([ts, "ERROR", message])
+
+def is_transient(e):
+    # Nur Quota-, Server- und Netzwerkfehler lohnen einen neuen Versuch; 400/403/404 bleiben falsch
+    if isinstance(e, gspread.exceptions.APIError):
+        code = getattr(e.response, "status_code", None) or 0
+        return code == 429 or code >= 500
+    return isinstance(e, (requests.exceptions.RequestException, ConnectionError, TimeoutError))
+
+def acquire_quota(kind):
+    limit = SHEETS_READS_PER_MIN if kind == "read" else SHEETS_WRITES_PER_MIN
+    while True:
+        with QUOTA["lock"]:
+            now = time.time()
+            window = QUOTA[kind]
+            while window and now - window[0] > 60: window.popleft()
+            if len(window) < limit:
+                window.append(now); return
+            wait = 60 - (now - window[0]) + 0.1
+        report_throttle(f"Sheets-{kind}-Limit erreicht, warte {wait:.0f}s")
+        time.sleep(wait)
+
+class QuotaWorksheet:
+    # Hülle um ein gspread-Worksheet: zählt Requests gegen das Minutenbudget, wartet statt zu
+    # scheitern und sammelt update_cell-Aufrufe zu einem batch_update.
+    READS = {"get_all_values", "get_all_records", "get_values", "get", "row_values", "col_values", "find", "findall", "acell", "cell"}
+    WRITES = {"update", "append_row", "append_rows", "insert_row", "insert_rows", "delete_rows", "clear", "batch_update", "add_rows", "add_cols", "resize"}
+    # Verschieben Zeilen: offene Zellen müssen vorher geschrieben oder verworfen sein, sonst treffen sie die falsche Zeile
+    SHIFTS = {"insert_row", "insert_rows", "delete_rows", "clear", "resize"}
+
+    def __init__(self, ws):
+        self._ws = ws
+        self._pending = {}
+        self._lock = threading.Lock()  # schützt nur _pending/_timer, nie über Netzwerkaufrufe
+        self._flush_lock = threading.Lock()  # hält Flushes in Reihenfolge
+        self._timer = None
+        self._failures = 0
+
+    def __getattr__(self, name):
+        attr = getattr(self._ws, name)
+        if name not in self.READS and name not in self.WRITES: return attr
+        kind = "read" if name in self.READS else "write"
+        def governed(*args, **kwargs):
+            # Offene Zellen zuerst schreiben, damit Lesen/Zeilenverschiebungen konsistent bleiben.
+            # Was dabei hängen bleibt, blockiert nichts; vor einer Verschiebung wird es verworfen.
+            self.flush(raise_errors=False)
+            if name in self.SHIFTS: self._discard_pending("Zeilen werden verschoben")
+            return self._call(kind, attr, *args, **kwargs)
+        return governed
+
+    def _call(self, kind, fn, *args, **kwargs):
+        for attempt in range(5):
+            acquire_quota(kind)
+            try: return fn(*args, **kwargs)
+            except gspread.exceptions.APIError as e:
+                if getattr(e.response, "status_code", None) != 429 or attempt == 4: raise
+                wait = 5 * 2 ** attempt
+                report_throttle(f"429 von Google ({self._ws.title}), neuer Versuch in {wait}s")
+                time.sleep(wait)
+
+    def _schedule(self, delay):
+        # Aufrufer hält self._lock
+        if self._timer is None:
+            self._timer = threading.Timer(delay, self._flush_later)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def update_cell(self, row, col, value):
+        with self._lock:
+            self._pending[(row, col)] = value
+            self._schedule(FLUSH_DELAY)
+
+    def flush(self, raise_errors=True):
+        with self._flush_lock:
+            with self._lock:
+                if self._timer: self._timer.cancel(); self._timer = None
+                batch, self._pending = self._pending, {}
+            if not batch: return
+            data = [{"range": gspread.utils.rowcol_to_a1(r, c), "values": [[v]]} for (r, c), v in batch.items()]
+            try: self._call("write", self._ws.batch_update, data, value_input_option="USER_ENTERED")
+            except Exception as e:
+                self._failures += 1
+                if is_transient(e) and self._failures < FLUSH_MAX_ATTEMPTS:
+                    with self._lock:
+                        # Zurücklegen, ohne neuere Werte für dieselbe Zelle zu überschreiben
+                        for cell, value in batch.items(): self._pending.setdefault(cell, value)
+                        self._schedule(min(FLUSH_RETRY_MAX, FLUSH_DELAY * 2 ** self._failures))
+                    report_write_error(f"{len(batch)} Zellen in '{self._ws.title}' nicht geschrieben, Versuch {self._failures}/{FLUSH_MAX_ATTEMPTS}: {e}")
+                else:
+                    self._failures = 0
+                    report_write_error(f"{len(batch)} Zellen in '{self._ws.title}' verworfen ({', '.join(d['range'] for d in data)}): {e}")
+                if raise_errors: raise
+            else: self._failures = 0
+
+    def _discard_pending(self, reason):
+        with self._flush_lock, self._lock:
+            if self._timer: self._timer.cancel(); self._timer = None
+            dropped, self._pending = self._pending, {}
+            self._failures = 0
+        if dropped:
+            cells = ", ".join(gspread.utils.rowcol_to_a1(r, c) for r, c in dropped)
+            report_write_error(f"{len(dropped)} Zellen in '{self._ws.title}' verworfen ({reason}): {cells}")
+
+    def _flush_later(self):
+        with self._lock: self._timer = None
+        self.flush(raise_errors=False)
+
+# --- SCHEMA ---
+# Die geprüfte Version steht als Developer-Metadata in der Tabelle; bei Änderungen an
+# BOOK_COLUMNS die SCHEMA_VERSION erhöhen, damit check_structure einmal migriert.
+BOOK_COLUMNS = ["Titel", "Autor", "Genre", "Bewertung", "Cover", "Hinzugefügt", "Notiz", "Status", "Tags", "Erschienen", "Teaser", "Bio", "Lesejahr"]
+SCHEMA_VERSION = 1
+SCHEMA_KEY = "leseliste_schema_version"
+
+@st.cache_resource
+def get_header_cache():
+    # Prozessweit: Worksheet-ID -> {spaltenname (klein): spaltennummer}
+    return {}
+
+HEADER_CACHE = get_header_cache()
+
+@st.cache_resource(show_spinner=False)
+def open_sheets(_client):
+    # Einmal pro Prozess: Tabelle öffnen und alle Worksheets mit einem Request holen
+    sh = _client.open("Bücherliste")
+    worksheets = sh.worksheets()
+    by_title = {w.title: w for w in worksheets}
+    ws_books = worksheets[0]
+    ws_logs = by_title.get("Logs")
+    if not ws_logs: ws_logs = sh.add_worksheet(title="Logs", rows=1000, cols=3); ws_logs.append_row(["Zeitstempel", "Typ", "Nachricht"])
+    ws_authors = by_title.get("Autoren")
+    if not ws_authors: ws_authors = sh.add_worksheet(title="Autoren", rows=1000, cols=1); ws_authors.update_cell(1, 1, "Name")
+    return sh, QuotaWorksheet(ws_books), QuotaWorksheet(ws_logs), QuotaWorksheet(ws_authors)
+
 def setup_sheets(client):
     if not client: return None, None, None, None
-    try: sh = client.open("Bücherliste") 
+    try: return open_sheets(client)
     except: st.error("Fehler: Tabelle 'Bücherliste' nicht gefunden."); st.stop()
-    ws_books = sh.sheet1
-    try: ws_logs = sh.worksheet("Logs")
-    except: ws_logs = sh.add_worksheet(title="Logs", rows=1000, cols=3); ws_logs.append_row(["Zeitstempel", "Typ", "Nachricht"])
-    try: ws_authors = sh.worksheet("Autoren")
-    except: ws_authors = sh.add_worksheet(title="Autoren", rows=1000, cols=1); ws_authors.update_cell(1, 1, "Name")
-    return sh, ws_books, ws_logs, ws_authors
+
+def get_col_map(ws):
+    if ws.id not in HEADER_CACHE:
+        HEADER_CACHE[ws.id] = {str(h).strip().lower(): i + 1 for i, h in enumerate(ws.row_values(1))}
+    return HEADER_CACHE[ws.id]
+
+def read_schema_version(sh):
+    meta = sh.fetch_sheet_metadata({"fields": "developerMetadata(metadataKey,metadataValue)"})
+    for m in meta.get("developerMetadata", []):
+        if m.get("metadataKey") == SCHEMA_KEY: return m.get("metadataValue")
+    return None
+
+# Logs: neueste Einträge stehen oben (Zeile 2), ältere wandern ins Archiv
+LOG_VIEW_ROWS = 50
+LOG_MAX_ROWS = 500
+LOG_MAX_AGE_DAYS = 30
+LOG_ARCHIVE_SHEET = "Logs-Archiv"
+
+@st.cache_resource
+def get_log_buffer():
+    # Prozessweite Kopie der letzten Log-Einträge für die Sidebar (ohne Sheets-Abfrage)
+    return deque(maxlen=LOG_VIEW_ROWS)
+
+LOG_BUFFER = get_log_buffer()
+
+@st.cache_resource
+def get_log_state():
+    # Lock gegen Verschiebungen: insert_row(index=2) und die Rotation dürfen sich nicht überholen
+    return {"lock": threading.Lock(), "rotated": False}
+
+LOG_STATE = get_log_state()
 
 def log_to_sheet(ws_logs, message, msg_type="INFO"):
     try:
         ts = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        ws_logs.insert_row([ts, msg_type, str(message)], index=2)
+        LOG_BUFFER.appendleft([ts, msg_type, str(message)])
+        with LOG_STATE["lock"]: ws_logs.insert_row([ts, msg_type, str(message)], index=2)
     except Exception: pass
 
-def check_structure(ws):
+def read_recent_logs(ws_logs, limit=LOG_VIEW_ROWS):
+    # Nur ein begrenztes Fenster lesen statt des ganzen Blatts
+    try: rows = ws_logs.get_values(f"A2:C{min(limit + 1, ws_logs.row_count)}")
+    except Exception: return []
+    return [(r + ["", "", ""])[:3] for r in rows if r and r[0]]
+
+def rotate_logs(sh, ws_logs):
+    # Einmal pro Prozess: Einträge jenseits von LOG_MAX_ROWS oder älter als LOG_MAX_AGE_DAYS ins Archiv
+    # verschieben. Der Lock hält log_to_sheet an, damit die Zeilennummern bis zum Löschen stimmen.
+    with LOG_STATE["lock"]:
+        if LOG_STATE["rotated"]: return 0
+        LOG_STATE["rotated"] = True
+        return _rotate_logs_locked(sh, ws_logs)
+
+def _rotate_logs_locked(sh, ws_logs):
+    try:
+        stamps = ws_logs.get_values(f"A2:A{min(LOG_MAX_ROWS + 1, ws_logs.row_count)}")
+        cutoff = datetime.now().timestamp() - LOG_MAX_AGE_DAYS * 86400
+        keep = len(stamps)
+        for i, r in enumerate(stamps):
+            try: ts = datetime.strptime(r[0], "%Y-%m-%d %H:%M:%S").timestamp()
+            except: continue
+            if ts < cutoff: keep = i; break
+        first_row = keep + 2
+        raw = ws_logs.get_values(f"A{first_row}:C")
+        overflow = [r for r in raw if r and r[0]]
+        if not overflow: return 0
+        try: ws_archive = QuotaWorksheet(sh.worksheet(LOG_ARCHIVE_SHEET))
+        except: ws_archive = QuotaWorksheet(sh.add_worksheet(title=LOG_ARCHIVE_SHEET, rows=1000, cols=3)); ws_archive.append_row(["Zeitstempel", "Typ", "Nachricht"])
+        ws_archive.append_rows(overflow[::-1])
+        ws_logs.delete_rows(first_row, first_row + len(raw) - 1)
+        return len(overflow)
+    except Exception: return 0
+
+def check_structure(sh, ws):
     if "structure_checked" in st.session_state: return
     try:
+        stored = read_schema_version(sh)
+        if stored == str(SCHEMA_VERSION):
+            get_col_map(ws); st.session_state.structure_checked = True; return
         head = ws.row_values(1)
-        if not head: ws.update_cell(1,1,"Titel"); head=["Titel"]
-        needed = ["Titel", "Autor", "Genre", "Bewertung", "Cover", "Hinzugefügt", "Notiz", "Status", "Tags", "Erschienen", "Teaser", "Bio", "Lesejahr"]
-        current_cols_lower = [h.lower() for h in head]
-        next_c = len(head) + 1
-        for n in needed:
-            if n.lower() not in current_cols_lower:
-                ws.update_cell(1, next_c, n); next_c += 1; time.sleep(0.5)
+        current_cols_lower = [str(h).strip().lower() for h in head]
+        missing = [n for n in BOOK_COLUMNS if n.lower() not in current_cols_lower]
+        if missing:
+            # Alle fehlenden Spalten in einem Request anhängen
+            if ws.col_count < len(head) + len(missing): ws.add_cols(len(head) + len(missing) - ws.col_count)
+            ws.update(range_name=gspread.utils.rowcol_to_a1(1, len(head) + 1), values=[missing])
+            head = head + missing
+        HEADER_CACHE[ws.id] = {str(h).strip().lower(): i + 1 for i, h in enumerate(head)}
+        requests_meta = [{"createDeveloperMetadata": {"developerMetadata": {
+            "metadataKey": SCHEMA_KEY, "metadataValue": str(SCHEMA_VERSION), "location": {"spreadsheet": True}, "visibility": "DOCUMENT"}}}]
+        if stored is not None:
+            requests_meta.insert(0, {"deleteDeveloperMetadata": {"dataFilter": {"developerMetadataLookup": {"metadataKey": SCHEMA_KEY}}}})
+        sh.batch_update({"requests": requests_meta})
         st.session_state.structure_checked = True
     except: pass
 
 # --- DATA ---
 def get_data_fresh(ws):
-    cols = ["Titel", "Autor", "Genre", "Bewertung", "Cover", "Hinzugefügt", "Notiz", "Status", "Tags", "Erschienen", "Teaser", "Bio", "Lesejahr"]
-    try:
-        raw = ws.get_all_values()
-        if len(raw) < 2: return pd.DataFrame(columns=cols)
-        h_map = {str(h).strip().lower(): i for i, h in enumerate(raw[0])}
-        data = []
-        for r in raw[1:]:
-            d = {}
-            for c in cols:
-                idx = h_map.get(c.lower())
-                val = r[idx] if idx is not None and idx < len(r) else ""
-                d[c] = val
-            try:
-                raw_val = d["Bewertung"]
-                d["Bewertung"] = int(raw_val) if str(raw_val).isdigit() else 0
-            except: d["Bewertung"] = 0
-            if not d["Status"]: d["Status"] = "Gelesen"
-            if d["Titel"]: data.append(d)
-        return pd.DataFrame(data)
-    except: return pd.DataFrame(columns=cols)
+    # Lesefehler nicht verschlucken: eine leere Tabelle würde sonst prozessweit zwischengespeichert
+    cols = BOOK_COLUMNS
+    raw = ws.get_all_values()
+    if len(raw) < 2: return pd.DataFrame(columns=cols)
+    h_map = {str(h).strip().lower(): i for i, h in enumerate(raw[0])}
+    data = []
+    for r in raw[1:]:
+        d = {}
+        for c in cols:
+            idx = h_map.get(c.lower())
+            val = r[idx] if idx is not None and idx < len(r) else ""
+            d[c] = val
+        try:
+            raw_val = d["Bewertung"]
+            d["Bewertung"] = int(raw_val) if str(raw_val).isdigit() else 0
+        except: d["Bewertung"] = 0
+        if not d["Status"]: d["Status"] = "Gelesen"
+        if d["Titel"]: data.append(d)
+    return pd.DataFrame(data)
+
+SORT_OPTIONS = ["Autor (A-Z)", "Titel (A-Z)", "Lesejahr (Neu -> Alt)"]
+
+def build_library(df):
+    # Einmal pro Datenstand: Status-Partitionen, Sortierreihenfolgen und Suchtext als Arrays.
+    # Die Ansichten arbeiten nur mit Positionen in df und verändern df nie.
+    titles = df["Titel"].astype(str)
+    title_key = titles.str.lower()
+    author_key = df["Autor"].map(lambda x: str(x).strip().split(' ')[-1] if x and str(x).strip() else "zzz").str.lower()
+    year_key = pd.to_numeric(df["Lesejahr"], errors="coerce").fillna(0)
+    keys = pd.DataFrame({"author": author_key, "title": title_key, "year": year_key, "raw_title": titles}).reset_index(drop=True)
+    orders = {
+        "Autor (A-Z)": keys.sort_values(["author", "title"]).index.to_numpy(),
+        "Titel (A-Z)": keys.sort_values("title", kind="stable").index.to_numpy(),
+        "Lesejahr (Neu -> Alt)": keys.sort_values(["year", "raw_title"], ascending=[False, True]).index.to_numpy(),
+    }
+    search = (titles + "\n" + df["Autor"].astype(str) + "\n" + df["Tags"].astype(str) + "\n" + df["Lesejahr"].astype(str)).str.lower()
+    status = df["Status"].to_numpy()
+    parts = {s: status == s for s in set(status)}
+    teaser = df["Teaser"].astype(str)
+    missing = np.flatnonzero((teaser.str.len() < 5) | teaser.str.contains("Fehler|Keine automatischen|Formatierungsfehler", regex=True).to_numpy())
+    authors = sorted(set(a for a, s in zip(df["Autor"], status) if a and s != "Wunschliste"))
+    for arr in list(orders.values()) + list(parts.values()) + [missing]: arr.setflags(write=False)
+    return {"df": df, "orders": orders, "search": search, "parts": parts, "missing": missing, "authors": authors}
+
+@st.cache_resource
+def get_data_state():
+    # Prozessweiter Datenstand; force_reload erhöht die Version für alle Sessions
+    return {"version": 0}
+
+@st.cache_resource(show_spinner="Lade Daten...", max_entries=2)
+def load_library(_ws, version):
+    lib = build_library(get_data_fresh(_ws))
+    lib["version"] = version
+    return lib
 
 def get_data(ws):
-    # AUTO-FIX: Wenn die Spalte Lesejahr im Cache fehlt, erzwinge Reload
-    if "df_books" in st.session_state:
-        if "Lesejahr" not in st.session_state.df_books.columns:
-            del st.session_state.df_books
-            
-    if "df_books" not in st.session_state:
-        with st.spinner("Lade Daten..."): st.session_state.df_books = get_data_fresh(ws)
-    return st.session_state.df_books
+    version = get_data_state()["version"]
+    try: lib = load_library(ws, version)
+    except Exception as e: st.error(f"Bücher konnten nicht geladen werden: {e}"); st.stop()
+    st.session_state.data_version = version
+    return lib
+
+def force_reload(data_state=None):
+    (data_state or get_data_state())["version"] += 1
 
-def force_reload():
-    if "df_books" in st.session_state: del st.session_state.df_books
+def partition(lib, status):
+    return lib["parts"].get(status, np.zeros(len(lib["df"]), dtype=bool))
 
 # --- AUTOMATIC CLEANUP & SYNC ---
 def auto_cleanup_authors(ws_books, ws_authors):
@@ -246,7 +569,6 @@ def auto_cleanup_authors(ws_books, ws_authors):
                     current = clean(row[idx_a])
                     if current in replacements:
                         ws_books.update_cell(i+1, idx_a+1, replacements[current])
-                        time.sleep(0.2)
         updated_vals = ws_books.get_all_values()
         final_authors = sorted(list(set([clean(row[idx_a]) for row in updated_vals[1:] if len(row) > idx_a and row[idx_a]])))
         if ws_authors:
@@ -266,34 +588,70 @@ def delete_book(ws, titel, ws_authors):
         return True
     except: return False
 
-def filter_and_sort_books(df_in, query, sort_by):
-    df = df_in.copy()
-    
-    # Sicherstellen, dass Lesejahr existiert (verhindert Absturz bei alten Caches)
-    if "Lesejahr" not in df.columns:
-        df["Lesejahr"] = ""
-
+def filter_and_sort_books(lib, status, query, sort_by, order=None):
+    # Liefert Positionen in lib["df"], keine Kopie der Tabelle
+    mask = partition(lib, status)
     if query:
-        q = query.lower()
-        mask = (
-            df['Titel'].str.lower().str.contains(q, na=False) |
-            df['Autor'].str.lower().str.contains(q, na=False) |
-            df['Tags'].str.lower().str.contains(q, na=False) |
-            # Umwandlung in String erzwingen für Zahlensuche
-            df['Lesejahr'].astype(str).str.contains(q, na=False)
-        )
-        df = df[mask]
-    
-    if sort_by == "Autor (A-Z)":
-        df['sort_key'] = df['Autor'].apply(lambda x: str(x).strip().split(' ')[-1] if x and str(x).strip() else "zzz")
-        df = df.sort_values(by=['sort_key', 'Titel'], key=lambda col: col.str.lower())
-    elif sort_by == "Titel (A-Z)":
-        df = df.sort_values(by='Titel', key=lambda col: col.str.lower())
-    elif sort_by == "Lesejahr (Neu -> Alt)":
-        df['year_sort'] = pd.to_numeric(df['Lesejahr'], errors='coerce').fillna(0)
-        df = df.sort_values(by=['year_sort', 'Titel'], ascending=[False, True])
-    
-    return df
+        mask = mask & lib["search"].str.contains(query.lower(), regex=False).to_numpy()
+    if order is None: order = lib["orders"].get(sort_by)
+    if order is None: return np.flatnonzero(mask)
+    return order[mask[order]]
+
+# --- EMPFEHLUNGEN ---
+# TF-IDF über Tags, Genre, Autor und Teaser; eine Zeile pro Buch, L2-normiert, damit ein
+# Skalarprodukt direkt die Kosinus-Ähnlichkeit ist.
+RECOMMEND_SORT = "Passt zu mir"
+SIMILAR_STOPWORDS = {"aber", "auch", "dass", "diese", "dieser", "doch", "eine", "einem", "einen", "einer", "eines", "für", "hier", "ihre",
+                     "immer", "nach", "nicht", "noch", "oder", "sein", "seine", "seiner", "sich", "sind", "über", "unter", "wenn", "werden",
+                     "wird", "zwei", "zwischen", "teaser", "buch", "roman"}
+
+def book_tokens(tags, genre, autor, teaser):
+    tokens = []
+    for t in str(tags).split(","):
+        t = t.strip().lower()
+        if t and t != "-": tokens += [f"tag:{t}"] * 3
+    if str(genre).strip(): tokens.append(f"genre:{str(genre).strip().lower()}")
+    if str(autor).strip(): tokens += [f"autor:{str(autor).strip().lower()}"] * 2
+    tokens += [w for w in re.findall(r"\w+", str(teaser).lower()) if len(w) > 3 and w not in SIMILAR_STOPWORDS and not w.isdigit()]
+    return tokens
+
+def build_similarity_matrix(df):
+    vocab, indptr, indices, data = {}, [0], [], []
+    for tags, genre, autor, teaser in zip(df["Tags"], df["Genre"], df["Autor"], df["Teaser"]):
+        for tok, c in Counter(book_tokens(tags, genre, autor, teaser)).items():
+            indices.append(vocab.setdefault(tok, len(vocab)))
+            data.append(1.0 + np.log(c))
+        indptr.append(len(indices))
+    n = len(df)
+    X = csr_matrix((data, indices, indptr), shape=(n, max(len(vocab), 1)), dtype=np.float64)
+    idf = np.log((1 + n) / (1 + np.bincount(X.indices, minlength=X.shape[1]))) + 1.0
+    X = X @ diags(idf)
+    norms = np.sqrt(np.asarray(X.multiply(X).sum(axis=1)).ravel())
+    norms[norms == 0] = 1.0
+    return (diags(1.0 / norms) @ X).tocsr()
+
+@st.cache_resource(show_spinner=False, max_entries=2)
+def get_similarity_matrix(_lib, version):
+    return build_similarity_matrix(_lib["df"])
+
+def similar_books(lib, pos, k=5):
+    X = get_similarity_matrix(lib, lib["version"])
+    scores = (X @ X[pos].T).toarray().ravel()
+    scores[pos] = 0.0
+    k = min(k, len(scores) - 1)
+    if k <= 0: return []
+    top = np.argpartition(-scores, k - 1)[:k]
+    top = top[np.argsort(-scores[top], kind="stable")]
+    return [(int(p), float(scores[p])) for p in top if scores[p] > 0]
+
+def recommendation_order(lib):
+    # Profil = nach Bewertung gewichtete Summe der gelesenen Bücher, dann Kosinus zu allen Büchern
+    X = get_similarity_matrix(lib, lib["version"])
+    read = partition(lib, "Gelesen")
+    weights = np.where(read, np.maximum(pd.to_numeric(lib["df"]["Bewertung"], errors="coerce").fillna(0).to_numpy(), 1), 0).astype(np.float64)
+    profile = X.T @ weights
+    scores = X @ profile
+    return np.argsort(-scores, kind="stable")
 
 # --- API HELPERS ---
 def process_genre(raw):
@@ -336,13 +694,78 @@ def fetch_meta_single(titel, autor):
     c = cands[0] if cands else "-"
     return c, "Roman", datetime.now().strftime("%Y") 
 
+# Wikipedia: nur Einleitung, begrenzt auf Zeichen- und Token-Budget (~4 Zeichen/Token)
+WIKI_API = "https://de.wikipedia.org/w/api.php"
+# Wikimedia verlangt einen aussagekräftigen User-Agent
+WIKI_HEADERS = {"User-Agent": "Leseliste/1.0 (https://github.com/trompiphil/leseliste)"}
+WIKI_MAX_CHARS = 1200  # TextExtracts liefert mit exchars höchstens 1200 Zeichen
+WIKI_MAX_TOKENS = 300
+WIKI_MISS_TTL = 86400
+
+@st.cache_resource
+def get_wiki_cache():
+    # Prozessweit: Suchanfrage -> gewählte Seite, Seite -> Begriffsklärung ja/nein,
+    # Suchanfrage -> Zeitpunkt "kein Artikel" (läuft nach WIKI_MISS_TTL ab)
+    return {"choice": {}, "disambig": {}, "miss": {}, "lock": threading.Lock()}
+
+WIKI_STOPWORDS = {"der", "die", "das", "den", "dem", "des", "und", "ein", "eine", "von", "the", "and"}
+
+def _words(text):
+    return set(w for w in re.findall(r"\w+", str(text).lower()) if len(w) > 2 and w not in WIKI_STOPWORDS)
+
+def score_wiki_hit(hit, titel, autor):
+    title_words, author_words = _words(titel), _words(autor)
+    hit_title, snippet = _words(hit.get("title", "")), _words(re.sub(r"<[^>]+>", "", hit.get("snippet", "")))
+    score = 2 * len(title_words & hit_title) + len(title_words & snippet)
+    score += 1.5 * len(author_words & (hit_title | snippet))
+    if "begriffsklärung" in hit_title: score -= 5
+    return score
+
+def clip_context(text, max_chars=WIKI_MAX_CHARS, max_tokens=WIKI_MAX_TOKENS):
+    limit = min(max_chars, max_tokens * 4)
+    text = re.sub(r"\s+", " ", text or "").strip()
+    if len(text) <= limit: return text
+    cut = text[:limit]
+    end = cut.rfind(". ")
+    return cut[:end + 1] if end > limit // 2 else cut
+
+def fetch_wiki_extract(title):
+    params = {"action": "query", "prop": "extracts|pageprops", "exintro": 1, "explaintext": 1, "exchars": min(WIKI_MAX_CHARS, WIKI_MAX_TOKENS * 4),
+              "ppprop": "disambiguation", "redirects": 1, "titles": title, "format": "json"}
+    r = requests.get(WIKI_API, params=params, headers=WIKI_HEADERS, timeout=10)
+    r.raise_for_status()
+    pages = r.json().get("query", {}).get("pages", {})
+    page = next(iter(pages.values()), {})
+    return page.get("extract", ""), "disambiguation" in page.get("pageprops", {})
+
 def get_wiki_info(titel, autor):
+    cache = get_wiki_cache()
+    key = f"{titel}|{autor}".lower()
     try:
-        search_query = f"{titel} {autor} buch roman"
-        results = wikipedia.search(search_query)
-        if not results: return ""
-        page = wikipedia.page(results[0])
-        return page.content[:3000] 
+        with cache["lock"]:
+            chosen = cache["choice"].get(key)
+            missed = cache["miss"].get(key)
+        if missed and time.time() - missed < WIKI_MISS_TTL: return ""
+        if chosen: candidates = [chosen]
+        else:
+            params = {"action": "query", "list": "search", "srsearch": f"{titel} {autor}", "srlimit": 5, "srprop": "snippet", "format": "json"}
+            r = requests.get(WIKI_API, params=params, headers=WIKI_HEADERS, timeout=10)
+            r.raise_for_status()
+            hits = r.json().get("query", {}).get("search", [])
+            scored = sorted(((score_wiki_hit(h, titel, autor), h["title"]) for h in hits), reverse=True)
+            candidates = [t for sc, t in scored if sc > 0]
+        for title in candidates:
+            with cache["lock"]:
+                if cache["disambig"].get(title): continue
+            extract, is_disambig = fetch_wiki_extract(title)
+            with cache["lock"]: cache["disambig"][title] = is_disambig
+            if is_disambig or not extract: continue
+            with cache["lock"]:
+                cache["choice"][key] = title
+                cache["miss"].pop(key, None)
+            return clip_context(extract)
+        with cache["lock"]: cache["miss"][key] = time.time()
+        return ""
     except: return ""
 
 def get_google_books_description(titel, autor):
@@ -356,7 +779,6 @@ def get_google_books_description(titel, autor):
     return ""
 
 # --- AI CORE ---
-@st.cache_data(show_spinner=False)
 def get_available_models(api_key):
     url = f"https://generativelanguage.googleapis.com/v1beta/models?key={api_key}"
     try:
@@ -369,6 +791,32 @@ def get_available_models(api_key):
         return []
     except: return []
 
+def refresh_models_async(api_key, force=False):
+    with SHARED_CACHE["lock"]:
+        if SHARED_CACHE["refreshing"]: return
+        if not force and time.time() - SHARED_CACHE["models_attempt"] < MODELS_RETRY: return
+        SHARED_CACHE["refreshing"] = True
+        SHARED_CACHE["models_attempt"] = time.time()
+    def run():
+        try:
+            models = get_available_models(api_key)
+            if models:
+                SHARED_CACHE["models"] = (time.time(), models)
+                write_disk_cache("models.json", json.dumps(models).encode("utf-8"))
+        finally: SHARED_CACHE["refreshing"] = False
+    threading.Thread(target=run, name="ModelRefresh", daemon=True).start()
+
+def get_models_cached(api_key):
+    # Blockiert nie: liefert Speicher-/Plattenstand und aktualisiert veraltete Listen im Hintergrund
+    entry = SHARED_CACHE["models"]
+    if entry is None:
+        data, mtime = read_disk_cache("models.json", float("inf"))
+        try: entry = (mtime, json.loads(data)) if data else (0, [])
+        except ValueError: entry = (0, [])
+        SHARED_CACHE["models"] = entry
+    if time.time() - entry[0] > MODELS_TTL: refresh_models_async(api_key)
+    return entry
+
 def call_ai_manual(prompt, model_name):
     api_key = st.secrets["gemini_api_key"]
     url = f"https://generativelanguage.googleapis.com/v1beta/models/{model_name}:generateContent?key={api_key}"
@@ -392,13 +840,56 @@ def call_ai_manual(prompt, model_name):
         except Exception as e: return None, str(e)
     return None, "Server Timeout (503)"
 
-def fetch_all_ai_data_manual(titel, autor, model_name):
-    wiki_text = get_wiki_info(titel, autor)
-    google_text = get_google_books_description(titel, autor)
+def call_ai_stream(prompt, model_name, on_text=None):
+    # Wie call_ai_manual, aber über streamGenerateContent (SSE); on_text bekommt den bisherigen Text
+    api_key = st.secrets["gemini_api_key"]
+    url = f"https://generativelanguage.googleapis.com/v1beta/models/{model_name}:streamGenerateContent?alt=sse&key={api_key}"
+    headers = {'Content-Type': 'application/json'}
+    data = {"contents": [{"parts": [{"text": prompt}]}]}
+    max_retries = 3
+    for attempt in range(max_retries):
+        try:
+            with requests.post(url, headers=headers, json=data, stream=True) as response:
+                if response.status_code == 200:
+                    # SSE ist laut Spezifikation UTF-8; ohne charset würde requests ISO-8859-1 annehmen
+                    response.encoding = "utf-8"
+                    txt = ""
+                    for line in response.iter_lines(decode_unicode=True):
+                        if not line or not line.startswith("data:"): continue
+                        try:
+                            chunk = json.loads(line[5:])
+                            parts = chunk['candidates'][0]['content']['parts']
+                        except: continue
+                        txt += "".join(p.get("text", "") for p in parts)
+                        if on_text: on_text(txt)
+                    if not txt: return None, "Parse Fehler"
+                    match = re.search(r'\{[\s\S]*\}', txt)
+                    if match: return match.group(0), None
+                    return txt, None
+                elif response.status_code == 503: time.sleep(3); continue
+                elif response.status_code == 429: return None, "RATE_LIMIT"
+                else: return None, f"Fehler {response.status_code}"
+        except Exception as e: return None, str(e)
+    return None, "Server Timeout (503)"
+
+def partial_json_field(txt, key):
+    # Liest einen (evtl. noch unvollständigen) String-Wert aus gestreamtem JSON
+    match = re.search(r'"' + key + r'"\s*:\s*"((?:[^"\\]|\\.)*)', txt or "")
+    if not match: return ""
+    raw = re.sub(r'\\(?:u[0-9a-fA-F]{0,3})?$', "", match.group(1))
+    try: return json.loads(f'"{raw}"')
+    except: return raw.replace('\\"', '"').replace("\\n", "\n")
+
+def build_ai_prompt(titel, autor):
+    # Wikipedia und Google Books parallel abfragen
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        f_wiki = pool.submit(get_wiki_info, titel, autor)
+        f_google = pool.submit(get_google_books_description, titel, autor)
+        wiki_text, google_text = f_wiki.result(), f_google.result()
     context_str = ""
     if wiki_text: context_str += f"WIKIPEDIA TEXT:\n{wiki_text}\n\n"
     if google_text: context_str += f"GOOGLE BOOKS TEXT:\n{google_text}\n\n"
-    prompt = f"""
+    return f"""
     Antworte NUR mit validem JSON.
     Buch: "{titel}" von {autor}.
     Hintergrundwissen (nutze dies prioritär, falls vorhanden):
@@ -409,18 +900,27 @@ def fetch_all_ai_data_manual(titel, autor, model_name):
     3. Ermittle das Jahr und Tags.
     JSON Format:
     {{
-      "tags": "3-5 Tags (Deutsch)",
-      "year": "Jahr (Zahl)",
       "teaser": "Teaser Text (Deutsch)",
-      "bio": "Bio Text (Deutsch)"
+      "bio": "Bio Text (Deutsch)",
+      "tags": "3-5 Tags (Deutsch)",
+      "year": "Jahr (Zahl)"
     }}
     """
-    txt, err = call_ai_manual(prompt, model_name)
+
+def parse_ai_data(txt, err):
     fallback = {"tags": "-", "year": "", "teaser": f"Keine Infos ({err})" if err else "Keine Infos.", "bio": "-"}
     if err: return fallback, err
     try: return json.loads(txt), None
     except: return {"tags": "-", "year": "", "teaser": "JSON Fehler.", "bio": "-"}, "JSON Error"
 
+def fetch_all_ai_data_manual(titel, autor, model_name):
+    txt, err = call_ai_manual(build_ai_prompt(titel, autor), model_name)
+    return parse_ai_data(txt, err)
+
+def fetch_all_ai_data_stream(titel, autor, model_name, on_text=None):
+    txt, err = call_ai_stream(build_ai_prompt(titel, autor), model_name, on_text)
+    return parse_ai_data(txt, err)
+
 def smart_author(short, known):
     s = short.strip().lower()
     for k in sorted(known, key=len, reverse=True):
@@ -428,37 +928,126 @@ def smart_author(short, known):
     return short
 
 # --- BACKGROUND WORKER ---
-def background_update_task(missing_indices, df_copy, model_name, ws_books, ws_logs, ws_authors):
+@st.cache_resource
+def get_bg_progress():
+    return {"total": 0, "done": 0, "current": ""}
+
+def write_ai_data(ws_books, row_num, ai_data, ai_cols):
+    c_tag, c_year, c_teaser, c_bio = ai_cols
+    if ai_data.get("tags") and ai_data["tags"] != "-": ws_books.update_cell(row_num, c_tag, ai_data["tags"])
+    if ai_data.get("year"): ws_books.update_cell(row_num, c_year, ai_data["year"])
+    ws_books.update_cell(row_num, c_teaser, ai_data.get("teaser", "-"))
+    if ai_data.get("bio") and ai_data["bio"] != "-": ws_books.update_cell(row_num, c_bio, ai_data.get("bio", "-"))
+
+def background_update_task(missing_indices, df_books, model_name, ws_books, ws_logs, ws_authors, progress):
+    progress.update(total=len(missing_indices), done=0, current="")
     log_to_sheet(ws_logs, "🚀 Hintergrund-Update gestartet", "START")
-    headers = [str(h).lower() for h in ws_books.row_values(1)]
+    cols = get_col_map(ws_books)
     try:
-        c_tag = headers.index("tags") + 1
-        c_year = headers.index("erschienen") + 1
-        c_teaser = headers.index("teaser") + 1
-        c_bio = headers.index("bio") + 1
+        c_tag = cols["tags"]
+        c_year = cols["erschienen"]
+        c_teaser = cols["teaser"]
+        c_bio = cols["bio"]
     except: 
         log_to_sheet(ws_logs, "Spaltenfehler im Background Worker", "ERROR")
         return
 
     for idx in missing_indices:
         try:
-            row = df_copy.loc[idx]
+            row = df_books.loc[idx]
+            progress["current"] = row["Titel"]
             ai_data, err = fetch_all_ai_data_manual(row["Titel"], row["Autor"], model_name)
             if err == "RATE_LIMIT":
                 time.sleep(60)
                 ai_data, err = fetch_all_ai_data_manual(row["Titel"], row["Autor"], model_name)
             if ai_data:
                 cell = ws_books.find(row["Titel"])
-                if ai_data.get("tags") and ai_data["tags"] != "-": ws_books.update_cell(cell.row, c_tag, ai_data["tags"])
-                if ai_data.get("year"): ws_books.update_cell(cell.row, c_year, ai_data["year"])
-                ws_books.update_cell(cell.row, c_teaser, ai_data.get("teaser", "-"))
-                if ai_data.get("bio") and ai_data["bio"] != "-": ws_books.update_cell(cell.row, c_bio, ai_data.get("bio", "-"))
+                write_ai_data(ws_books, cell.row, ai_data, (c_tag, c_year, c_teaser, c_bio))
                 log_to_sheet(ws_logs, f"Background: {row['Titel']} fertig", "SUCCESS")
             time.sleep(1.0)
         except Exception as e: log_to_sheet(ws_logs, f"Error bei {row['Titel']}: {e}", "ERROR")
+        progress["done"] += 1
+    progress["current"] = "Autoren abgleichen"
     auto_cleanup_authors(ws_books, ws_authors)
     log_to_sheet(ws_logs, "✅ Hintergrund-Update beendet", "DONE")
 
+# --- COVER QUEUE ---
+# Neue Bücher werden sofort mit Platzhalter gespeichert, Cover (und optional KI-Infos) kommen danach
+PENDING_COVER = "⏳"
+
+@st.cache_resource
+def get_cover_queue():
+    return {"queue": queue.Queue(), "pending": 0, "thread": None, "swept": False, "sweeping": False, "finished": deque(maxlen=200), "lock": threading.Lock()}
+
+def appended_row(response):
+    # Antwort von values.append: updates.updatedRange, z.B. "Tabelle1!A42:M42"
+    try: return int(re.search(r"![A-Z]+(\d+)", response["updates"]["updatedRange"]).group(1))
+    except Exception: return None
+
+def find_pending_row(ws_books, titel, row_hint=None):
+    # Die Zeile mit diesem Titel, die noch den Platzhalter trägt; ältere Zeilen gleichen Titels bleiben unberührt
+    cols = get_col_map(ws_books)
+    c_title, c_cover = cols.get("titel", 1), cols.get("cover", 5)
+    def is_pending(row): return len(row) >= max(c_title, c_cover) and row[c_title - 1] == titel and row[c_cover - 1] == PENDING_COVER
+    if row_hint and is_pending(ws_books.row_values(row_hint)): return row_hint
+    for i, row in enumerate(ws_books.get_all_values()):
+        if i > 0 and is_pending(row): return i + 1
+    return None
+
+def cover_worker(jobs, ws_books, ws_logs, ws_authors, data_state):
+    while True:
+        titel, autor, log_msg, log_type, model_name, row_hint = jobs["queue"].get()
+        row_num, cover_written = None, False
+        try:
+            log_to_sheet(ws_logs, log_msg, log_type)
+            c = fetch_meta_single(titel, autor)[0]
+            row_num = find_pending_row(ws_books, titel, row_hint)
+            if row_num is None: raise LookupError("keine Zeile mit Platzhalter gefunden")
+            cols = get_col_map(ws_books)
+            ws_books.update_cell(row_num, cols.get("cover", 5), c or "-")
+            ws_books.flush()
+            cover_written = True
+            if model_name:
+                ai_data, err = fetch_all_ai_data_manual(titel, autor, model_name)
+                if not err:
+                    ai_cols = tuple(cols[h] for h in ("tags", "erschienen", "teaser", "bio"))
+                    write_ai_data(ws_books, row_num, ai_data, ai_cols)
+            if jobs["queue"].empty(): auto_cleanup_authors(ws_books, ws_authors)
+        except Exception as e:
+            log_to_sheet(ws_logs, f"Cover-Fehler bei {titel}: {e}", "ERROR")
+            # Platzhalter nicht stehen lassen; ein Cover lässt sich später über die Galerie setzen
+            if row_num is not None and not cover_written:
+                try: ws_books.update_cell(row_num, get_col_map(ws_books).get("cover", 5), "-")
+                except Exception: pass
+        finally:
+            with jobs["lock"]: jobs["pending"] -= 1; jobs["finished"].append(titel)
+            force_reload(data_state)
+            jobs["queue"].task_done()
+
+def enqueue_cover_job(titel, autor, log_msg, log_type, ws_books, ws_logs, ws_authors, model_name=None, row_hint=None):
+    jobs = get_cover_queue()
+    with jobs["lock"]:
+        jobs["pending"] += 1
+        if jobs["thread"] is None or not jobs["thread"].is_alive():
+            jobs["thread"] = threading.Thread(target=cover_worker, args=(jobs, ws_books, ws_logs, ws_authors, get_data_state()), name="CoverWorker", daemon=True)
+            jobs["thread"].start()
+    jobs["queue"].put((titel, autor, log_msg, log_type, model_name, row_hint))
+
+def requeue_pending_covers(lib, ws_books, ws_logs, ws_authors):
+    # Einmal pro Prozess: Zeilen, die nach einem Neustart noch den Platzhalter tragen, erneut einreihen
+    jobs = get_cover_queue()
+    # lib stammt aus einem erfolgreichen Laden (get_data stoppt sonst); erst nach dem Durchlauf als erledigt markieren
+    with jobs["lock"]:
+        if jobs["swept"] or jobs["sweeping"]: return
+        jobs["sweeping"] = True
+    try:
+        df = lib["df"]
+        for pos in np.flatnonzero(df["Cover"].to_numpy() == PENDING_COVER):
+            row = df.iloc[pos]
+            enqueue_cover_job(row["Titel"], row["Autor"], f"Cover nachgeholt: {row['Titel']}", "COVER", ws_books, ws_logs, ws_authors)
+        jobs["swept"] = True
+    finally: jobs["sweeping"] = False
+
 # --- UI DIALOGS ---
 @st.dialog("🖼️ Cover auswählen")
 def open_cover_gallery(book, ws_books, ws_logs, ws_authors):
@@ -476,10 +1065,8 @@ def open_cover_gallery(book, ws_books, ws_logs, ws_authors):
                 if st.button("Übernehmen", key=f"gal_btn_{i}"):
                     try:
                         cell = ws_books.find(book["Titel"])
-                        headers = [str(h).lower() for h in ws_books.row_values(1)]
-                        try: c_col = headers.index("cover") + 1
-                        except: c_col = 5
-                        ws_books.update_cell(cell.row, c_col, img_url)
+                        ws_books.update_cell(cell.row, get_col_map(ws_books).get("cover", 5), img_url)
+                        ws_books.flush()
                         log_to_sheet(ws_logs, f"Neues Cover gesetzt: {book['Titel']}", "UPDATE")
                         auto_cleanup_authors(ws_books, ws_authors)
                         force_reload()
@@ -519,6 +1106,25 @@ def show_book_details(book, ws_books, ws_authors, ws_logs):
                 <b>👤 Autor</b><br>{book.get('Bio', '-')}
             </div>
             """, unsafe_allow_html=True)
+        # Direkt laden statt get_data: der Dialog darf data_version der Sitzung nicht verschieben
+        try: lib = load_library(ws_books, get_data_state()["version"])
+        except Exception: lib = None
+        # book stammt evtl. aus einem älteren Datenstand: Position nur nutzen, wenn der Titel noch passt
+        pos = None
+        if lib is None: pass
+        elif book.name in lib["df"].index and lib["df"].at[book.name, "Titel"] == book["Titel"]:
+            pos = lib["df"].index.get_loc(book.name)
+        else:
+            matches = np.flatnonzero(lib["df"]["Titel"].to_numpy() == book["Titel"])
+            if len(matches): pos = int(matches[0])
+        if pos is not None:
+            similar = similar_books(lib, pos)
+            if similar:
+                st.markdown("**👀 Ähnliche Bücher**")
+                for p, score in similar:
+                    other = lib["df"].iloc[p]
+                    mark = "🔮 " if other["Status"] == "Wunschliste" else ""
+                    st.markdown(f"- {mark}**{other['Titel']}** – {other['Autor']}")
             
     with t2:
         st.write("📝 **Daten bearbeiten**")
@@ -553,10 +1159,20 @@ def show_book_details(book, ws_books, ws_authors, ws_logs):
         st.markdown("---")
         st.write("✨ **KI-Aktionen**")
         if st.button("🪄 Infos neu generieren (Triple Engine)", type="primary"):
+            live_box = st.empty()
+            def show_partial(txt):
+                live_box.markdown(f"""
+                <div class="box-teaser">
+                    <b>📖 Teaser</b><br>{partial_json_field(txt, "teaser") or "..."}
+                </div>
+                <div class="box-author">
+                    <b>👤 Autor</b><br>{partial_json_field(txt, "bio") or "..."}
+                </div>
+                """, unsafe_allow_html=True)
             with st.spinner("Recherchiere (Wiki + Google + KI)..."):
-                mod_name = st.session_state.get("selected_model_name", "gemma-3-27b-it")
-                ai_data, err = fetch_all_ai_data_manual(new_title, new_author, mod_name)
-                if ai_data:
+                mod_name = st.session_state.get("selected_model_name", DEFAULT_MODEL)
+                ai_data, err = fetch_all_ai_data_stream(new_title, new_author, mod_name, show_partial)
+                if not err:
                     st.session_state.temp_ai_data = ai_data
                     st.success("Generiert! Bitte unten speichern.")
                 else: st.error(f"Fehler: {err}")
@@ -565,21 +1181,15 @@ def show_book_details(book, ws_books, ws_authors, ws_logs):
         if st.button("💾 Alle Änderungen speichern", type="primary"):
             try:
                 cell = ws_books.find(book["Titel"])
-                headers = [str(h).lower() for h in ws_books.row_values(1)]
-                col_t = headers.index("titel") + 1
-                col_a = headers.index("autor") + 1
-                try: col_c = headers.index("cover") + 1
-                except: col_c = 5
-                try: col_tags = headers.index("tags") + 1
-                except: col_tags = len(headers) + 1 
-                try: col_y = headers.index("erschienen") + 1
-                except: col_y = len(headers) + 2
-                try: col_teaser = headers.index("teaser") + 1
-                except: col_teaser = len(headers) + 3
-                try: col_bio = headers.index("bio") + 1
-                except: col_bio = len(headers) + 4
-                try: col_read_year = headers.index("lesejahr") + 1
-                except: col_read_year = len(headers) + 5
+                col_map = get_col_map(ws_books)
+                col_t = col_map["titel"]
+                col_a = col_map["autor"]
+                col_c = col_map.get("cover", 5)
+                col_tags = col_map["tags"]
+                col_y = col_map["erschienen"]
+                col_teaser = col_map["teaser"]
+                col_bio = col_map["bio"]
+                col_read_year = col_map["lesejahr"]
                 
                 final_teaser = book.get("Teaser", "")
                 final_bio = book.get("Bio", "")
@@ -598,6 +1208,7 @@ def show_book_details(book, ws_books, ws_authors, ws_logs):
                 ws_books.update_cell(cell.row, col_teaser, final_teaser)
                 ws_books.update_cell(cell.row, col_bio, final_bio)
                 ws_books.update_cell(cell.row, col_read_year, new_read_year)
+                ws_books.flush()
                 
                 auto_cleanup_authors(ws_books, ws_authors)
                 force_reload()
@@ -613,6 +1224,54 @@ def show_book_details(book, ws_books, ws_authors, ws_logs):
                 st.success("Gelöscht!"); time.sleep(1); st.rerun()
 
 
+# --- SIDEBAR FRAGMENTS ---
+# Laufen im eigenen Takt und lesen nur Prozess-Speicher, nicht Google Sheets
+@st.fragment(run_every=2)
+def sidebar_status():
+    progress = get_bg_progress()
+    cover_jobs = get_cover_queue()
+    if st.session_state.background_status == "running":
+        st.markdown("<div class='status-running'>🔄 Hintergrund-Update läuft...</div>", unsafe_allow_html=True)
+        if progress["total"]:
+            st.progress(progress["done"] / progress["total"], text=f"{progress['done']}/{progress['total']} · {progress['current']}")
+        is_running = any(t.name == "BackgroundUpdater" for t in threading.enumerate())
+        if not is_running:
+            st.session_state.background_status = "idle"
+            st.session_state.bg_message = "✅ Laden abgeschlossen!"
+            force_reload()
+            st.rerun()
+    if cover_jobs["pending"] > 0:
+        st.caption(f"🖼️ {cover_jobs['pending']} Cover werden gesucht...")
+    if QUOTA["last_event"] and time.time() - QUOTA["last_event"][0] < 120:
+        st.caption(f"⏸️ Sheets-Limit: {QUOTA['throttled']}× gedrosselt – {QUOTA['last_event'][1]}")
+    # Neuer Datenstand: nur bei eigenen Cover-Jobs automatisch neu zeichnen; Änderungen anderer
+    # Sessions würden sonst offene Dialoge samt ungespeicherter Eingaben schließen
+    if st.session_state.get("data_version") != get_data_state()["version"]:
+        own = st.session_state.get("own_covers", set())
+        with cover_jobs["lock"]: finished = own & set(cover_jobs["finished"])
+        if finished:
+            st.session_state.own_covers = own - finished
+            st.rerun()
+        if st.button("🔄 Neue Daten – neu laden", key="reload_new_data", use_container_width=True): st.rerun()
+
+@st.fragment(run_every=5)
+def log_viewer(ws_logs):
+    refresh = st.button("🔄 Logs neu laden", key="log_refresh")
+    if refresh or "log_window" not in st.session_state:
+        st.session_state.log_window = read_recent_logs(ws_logs)
+    # Einträge dieses Prozesses, die seit dem letzten Lesen dazugekommen sind, vorne anfügen.
+    # Erst kopieren: Worker-Threads schreiben gleichzeitig in LOG_BUFFER.
+    newest = st.session_state.log_window[0][0] if st.session_state.log_window else ""
+    logs = [l for l in list(LOG_BUFFER) if l[0] > newest] + st.session_state.log_window
+    if logs:
+        log_types = sorted(set(l[1] for l in logs if l[1]))
+        sel_types = st.multiselect("Typ", log_types, placeholder="Alle Typen", label_visibility="collapsed", key="log_types")
+        if sel_types: logs = [l for l in logs if l[1] in sel_types]
+        txt = ""
+        for l in logs[:10]: txt += f"{l[0]} | {l[1]} | {l[2]}\n"
+        st.code(txt or "Keine Einträge für diesen Filter.")
+    else: st.write("Keine Logs")
+
 # --- MAIN ---
 def main():
     st.title("Meine Leseliste")
@@ -622,36 +1281,31 @@ def main():
     client, creds = get_connection()
     if not client: st.error("Secrets fehlen!"); st.stop()
     
-    if "placeholder_img" not in st.session_state:
-        st.session_state.placeholder_img = get_placeholder_from_drive(creds)
+    st.session_state.placeholder_img = get_placeholder(creds)
     
     sheets_res = setup_sheets(client)
     if not sheets_res or not sheets_res[0]: st.error("Fehler bei der Verbindung zu Google Sheets."); st.stop()
         
     sh, ws_books, ws_logs, ws_authors = sheets_res
-    check_structure(ws_books)
-    df = get_data(ws_books)
-    authors = list(set([a for i, row in df.iterrows() if row["Status"] != "Wunschliste" for a in [row["Autor"]] if a]))
+    check_structure(sh, ws_books)
+    rotate_logs(sh, ws_logs)
+    lib = get_data(ws_books)
+    df = lib["df"]
+    authors = lib["authors"]
+    requeue_pending_covers(lib, ws_books, ws_logs, ws_authors)
     
     with st.sidebar:
         st.write("🔧 **Einstellungen**")
         
-        missing_count = 0
-        missing_indices = []
-        if not df.empty:
-            for i, r in df.iterrows():
-                teaser = str(r.get("Teaser", ""))
-                is_error = "Fehler" in teaser or "Keine automatischen" in teaser or "Formatierungsfehler" in teaser
-                if len(teaser) < 5 or is_error:
-                    missing_count += 1
-                    missing_indices.append(i)
+        missing_indices = lib["missing"]
+        missing_count = len(missing_indices)
                     
         st.write("🤖 **KI-Update**")
         if missing_count > 0:
             st.warning(f"{missing_count} Bücher offen.")
             if st.button("✨ Infos laden", type="primary", use_container_width=True):
-                if not 'selected_model_name' in st.session_state: st.session_state.selected_model_name = "gemma-3-27b-it" 
-                t = threading.Thread(target=background_update_task, args=(missing_indices, df.copy(), st.session_state.selected_model_name, ws_books, ws_logs, ws_authors), name="BackgroundUpdater")
+                if not 'selected_model_name' in st.session_state: st.session_state.selected_model_name = DEFAULT_MODEL 
+                t = threading.Thread(target=background_update_task, args=(missing_indices, df, st.session_state.selected_model_name, ws_books, ws_logs, ws_authors, get_bg_progress()), name="BackgroundUpdater")
                 t.start()
                 st.session_state.background_status = "running"
                 st.toast("Hintergrund-Update gestartet!")
@@ -659,15 +1313,8 @@ def main():
                 st.rerun()
         else: st.success("Alles aktuell.")
 
-        if st.session_state.background_status == "running":
-            st.markdown("<div class='status-running'>🔄 Hintergrund-Update läuft...</div>", unsafe_allow_html=True)
-            is_running = any(t.name == "BackgroundUpdater" for t in threading.enumerate())
-            if not is_running:
-                st.session_state.background_status = "idle"
-                st.session_state.bg_message = "✅ Laden abgeschlossen!"
-                force_reload()
-                st.rerun()
-        
+        sidebar_status()
+
         if st.session_state.bg_message:
             st.toast(st.session_state.bg_message)
             st.session_state.bg_message = None
@@ -675,17 +1322,20 @@ def main():
         st.markdown("---")
         st.write("⚙️ **Verwaltung**")
         st.link_button("📂 Tabelle öffnen", f"https://docs.google.com/spreadsheets/d/{sh.id}", use_container_width=True)
-        st.button("🔄 Cache leeren", use_container_width=True, on_click=lambda: (force_reload(), st.rerun()))
+        st.button("🔄 Cache leeren", use_container_width=True, on_click=lambda: (force_reload(), HEADER_CACHE.clear(), st.rerun()))
+        if st.button("♻️ Modelle & Platzhalter neu laden", use_container_width=True):
+            if "gemini_api_key" in st.secrets: refresh_models_async(st.secrets["gemini_api_key"], force=True)
+            st.session_state.placeholder_img = get_placeholder(creds, refresh=True)
+            st.toast("Platzhalter neu geladen, Modelle folgen im Hintergrund.")
         if st.button("🛠️ Schreibtest", use_container_width=True):
-            try: ws_logs.update_cell(1, 3, "TEST_OK"); log_to_sheet(ws_logs, "Test", "DEBUG"); st.success("Erfolg!")
+            try: ws_logs.update_cell(1, 3, "TEST_OK"); ws_logs.flush(); log_to_sheet(ws_logs, "Test", "DEBUG"); st.success("Erfolg!")
             except Exception as e: st.error(f"Fehler: {e}")
             
         st.markdown("---")
-        if "available_models_list" not in st.session_state:
-            with st.spinner("Lade Modelle..."):
-                if "gemini_api_key" in st.secrets: st.session_state.available_models_list = get_available_models(st.secrets["gemini_api_key"])
-                else: st.session_state.available_models_list = []
-        models = st.session_state.available_models_list
+        models = []
+        if "gemini_api_key" in st.secrets:
+            models = get_models_cached(st.secrets["gemini_api_key"])[1]
+        if not models: models = [DEFAULT_MODEL]
         default_idx = 0
         search_prio = ["gemma-3-27b", "gemma-3"] 
         found = False
@@ -693,18 +1343,13 @@ def main():
             for i, m in enumerate(models):
                 if prio in m: default_idx = i; found = True; break
             if found: break
-        selected_model = st.selectbox("🧠 KI-Modell", models, index=default_idx if models else None)
+        # Bisherige Wahl behalten, wenn sich die Modell-Liste im Hintergrund ändert
+        if st.session_state.get("model_select") in models: default_idx = models.index(st.session_state.model_select)
+        selected_model = st.selectbox("🧠 KI-Modell", models, index=default_idx if models else None, key="model_select")
         st.session_state.selected_model_name = selected_model
         
         with st.expander("📜 System-Log", expanded=False):
-            try:
-                logs = ws_logs.get_all_values()
-                if len(logs) > 1:
-                    last_logs = logs[:10]
-                    txt = ""
-                    for l in last_logs: txt += f"{l[0]} | {l[2]}\n"
-                    st.code(txt)
-            except: st.write("Keine Logs")
+            log_viewer(ws_logs)
 
     st.write("")
     nav = st.radio("Navigation", NAV_OPTIONS, 
@@ -725,38 +1370,41 @@ def main():
                 note = st.text_input("Notiz")
                 read_year = st.text_input("Gelesen im Jahr (optional)")
                 rate = st.feedback("stars")
+            enrich = st.checkbox("🤖 KI-Infos im Hintergrund laden")
             if st.form_submit_button("Speichern"):
                 if "," in inp:
                     val = (rate + 1) if rate is not None else 0
                     t, a = [x.strip() for x in inp.split(",", 1)]
                     fa = smart_author(a, authors)
                     final_read_year = read_year.strip() if read_year else str(datetime.now().year)
-                    with st.spinner("Speichere..."):
-                        c, g, y = fetch_meta_single(t, fa)
-                        ws_books.append_row([t, fa, g, val, c or "-", datetime.now().strftime("%Y-%m-%d"), note, "Gelesen", "", y or "", "", "", final_read_year])
-                        log_to_sheet(ws_logs, f"Neu: {t}", "NEW")
-                        auto_cleanup_authors(ws_books, ws_authors)
-                        force_reload()
-                    st.success(f"Gespeichert: {t}"); st.balloons(); time.sleep(1.0); st.rerun()
+                    res = ws_books.append_row([t, fa, "Roman", val, PENDING_COVER, datetime.now().strftime("%Y-%m-%d"), note, "Gelesen", "", datetime.now().strftime("%Y"), "", "", final_read_year])
+                    model_name = st.session_state.get("selected_model_name") if enrich else None
+                    enqueue_cover_job(t, fa, f"Neu: {t}", "NEW", ws_books, ws_logs, ws_authors, model_name, appended_row(res))
+                    st.session_state.setdefault("own_covers", set()).add(t)
+                    force_reload()
+                    st.session_state.bg_message = f"Gespeichert: {t}"
+                    st.rerun()
                 else: st.error("Format: Titel, Autor")
 
     # --- RENDER FUNKTION ---
-    def render_library_view(dataset, is_wishlist=False):
+    def render_library_view(status, is_wishlist=False):
         c1, c2 = st.columns([2, 1])
         with c1: q = st.text_input("Suche (Titel, Autor, Tags, Jahr)", placeholder="Suchen...", label_visibility="collapsed")
-        with c2: sort_by = st.selectbox("Sortieren", ["Autor (A-Z)", "Titel (A-Z)", "Lesejahr (Neu -> Alt)"], label_visibility="collapsed")
+        with c2: sort_by = st.selectbox("Sortieren", SORT_OPTIONS + ([RECOMMEND_SORT] if is_wishlist else []), label_visibility="collapsed", key=f"sort_{is_wishlist}")
         view_mode = st.radio("Ansicht", ["Kacheln", "Liste"], horizontal=True, label_visibility="collapsed", key=f"v_{is_wishlist}")
         
-        df_filtered = filter_and_sort_books(dataset, q, sort_by)
-        if df_filtered.empty:
+        order = recommendation_order(lib) if sort_by == RECOMMEND_SORT else None
+        positions = filter_and_sort_books(lib, status, q, sort_by, order)
+        if len(positions) == 0:
             st.info("Keine Bücher gefunden.")
             return
 
         if view_mode == "Liste":
             cols_show = ["Titel", "Autor", "Notiz", "Lesejahr"]
             if not is_wishlist: cols_show.insert(2, "Bewertung")
-            cols_show = [c for c in cols_show if c in df_filtered.columns]
-            df_display = df_filtered[cols_show].copy()
+            cols_show = [c for c in cols_show if c in df.columns]
+            # Nur die angezeigten Zeilen/Spalten landen im Editor
+            df_display = df.iloc[positions, [df.columns.get_loc(c) for c in cols_show]]
             df_display.insert(0, "Info", False)
             edited = st.data_editor(df_display, column_config={
                 "Info": st.column_config.CheckboxColumn("Info", width="small"),
@@ -767,14 +1415,12 @@ def main():
             }, hide_index=True, use_container_width=True, key=f"ed_{is_wishlist}")
             if edited["Info"].any():
                 sel_idx = edited[edited["Info"]].index[0]
-                orig_title = df_display.iloc[sel_idx]["Titel"]
-                orig_row = df[df["Titel"] == orig_title].iloc[0]
-                show_book_details(orig_row, ws_books, ws_authors, ws_logs)
+                show_book_details(df.loc[sel_idx], ws_books, ws_authors, ws_logs)
         else:
-            for i in range(0, len(df_filtered), 3):
-                batch = df_filtered.iloc[i:i+3]
+            for i in range(0, len(positions), 3):
                 cols = st.columns(3)
-                for j, (idx, row) in enumerate(batch.iterrows()):
+                for j, pos in enumerate(positions[i:i+3]):
+                    idx, row = df.index[pos], df.iloc[pos]
                     with cols[j]:
                         with st.container(border=True):
                             c_img, c_content = st.columns([1, 2])
@@ -806,14 +1452,15 @@ def main():
                                 if is_wishlist:
                                     if st.button("✅ Gelesen", key=f"read_{idx}", use_container_width=True):
                                         cell = ws_books.find(row["Titel"])
-                                        ws_books.update_cell(cell.row, 8, "Gelesen")
-                                        ws_books.update_cell(cell.row, 6, datetime.now().strftime("%Y-%m-%d"))
+                                        col_map = get_col_map(ws_books)
+                                        ws_books.update_cell(cell.row, col_map.get("status", 8), "Gelesen")
+                                        ws_books.update_cell(cell.row, col_map.get("hinzugefügt", 6), datetime.now().strftime("%Y-%m-%d"))
+                                        ws_books.flush()
                                         force_reload()
                                         st.rerun()
 
     if st.session_state.active_tab == "🔍 Sammlung":
-        df_s = df[df["Status"] == "Gelesen"].copy()
-        render_library_view(df_s, is_wishlist=False)
+        render_library_view("Gelesen", is_wishlist=False)
 
     elif st.session_state.active_tab == "🔮 Merkliste":
         with st.expander("➕ Neuer Wunsch"):
@@ -824,19 +1471,19 @@ def main():
                     if "," in iw:
                         t, a = [x.strip() for x in iw.split(",", 1)]
                         fa = smart_author(a, authors)
-                        c, g, y = fetch_meta_single(t, fa)
-                        ws_books.append_row([t, fa, g, "", c or "-", datetime.now().strftime("%Y-%m-%d"), inote, "Wunschliste", "", y or "", "", "", ""])
-                        auto_cleanup_authors(ws_books, ws_authors)
+                        res = ws_books.append_row([t, fa, "Roman", "", PENDING_COVER, datetime.now().strftime("%Y-%m-%d"), inote, "Wunschliste", "", datetime.now().strftime("%Y"), "", "", ""])
+                        enqueue_cover_job(t, fa, f"Wunsch: {t}", "WISH", ws_books, ws_logs, ws_authors, row_hint=appended_row(res))
+                        st.session_state.setdefault("own_covers", set()).add(t)
                         force_reload()
-                        log_to_sheet(ws_logs, f"Wunsch: {t}", "WISH"); st.success("Gemerkt!"); st.balloons(); time.sleep(1); st.rerun()
-        df_w = df[df["Status"] == "Wunschliste"].copy()
-        if not df_w.empty:
-            render_library_view(df_w, is_wishlist=True)
+                        st.session_state.bg_message = "Gemerkt!"
+                        st.rerun()
+        if partition(lib, "Wunschliste").any():
+            render_library_view("Wunschliste", is_wishlist=True)
         else: st.info("Leer.")
 
     elif st.session_state.active_tab == "👥 Statistik":
         st.header("📊 Statistik")
-        df_r = df[df["Status"] == "Gelesen"]
+        df_r = df[partition(lib, "Gelesen")]
         c1, c2 = st.columns(2)
         c1.metric("Gelesen", len(df_r))
         top_author_name = "-"